@@ -2,16 +2,13 @@
 # © 2025. Herramienta de apoyo clínico (no sustituye juicio profesional).
 
 import streamlit as st
-import numpy as np
 import pandas as pd
+import textwrap
+from bisect import bisect_right
 from io import BytesIO
+from itertools import accumulate
 from datetime import date, datetime
 
-# PDFs
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import inch
-
 # ============== Apariencia "premium" ==============
 st.set_page_config(
     page_title="Diabetes ADA MX – PLUS/PRO",
@@ -20,9 +17,8 @@ st.set_page_config(
     initial_sidebar_state="expanded",
 )
 
-# CSS fino (colores suaves, tarjetas, badges)
-st.markdown(
-    """
+# CSS fino (colores suaves, tarjetas, badges); constante de módulo, se envía tal cual
+CSS = """
     <style>
       :root{
         --accent:#2563eb;      /* azul */
@@ -41,9 +37,8 @@ st.markdown(
       hr{border:0;border-top:1px solid #e5e7eb;margin:1rem 0}
       .small{font-size:.9rem}
     </style>
-    """,
-    unsafe_allow_html=True,
-)
+"""
+st.markdown(CSS, unsafe_allow_html=True)
 
 # ============== Encabezado ==============
 left, mid, right = st.columns([1.2, 0.6, 1])
@@ -61,26 +56,35 @@ with right:
     st.caption("")
 
 # ============== Utilidades ==============
+_MG_PER_MMOL = 18.0  # glucosa: 1 mmol/L ≈ 18 mg/dL
+
 def mgdl_to_mmoll(v):
-    try:
-        return round(float(v) / 18.0, 1)
-    except Exception:
-        return None
+    return None if v is None else round(v / _MG_PER_MMOL, 1)
 
 def mmoll_to_mgdl(v):
-    try:
-        return round(float(v) * 18.0, 0)
-    except Exception:
-        return None
+    return None if v is None else round(v * _MG_PER_MMOL, 0)
+
+# Constantes CKD-EPI 2021 por sexo: (K, alfa, factor)
+_EGFR_MUJER = (0.7, -0.241, 1.012)
+_EGFR_HOMBRE = (0.9, -0.302, 1.0)
+
+def _egfr_core(scr_mgdl, age, K, a, adj):
+    # Núcleo numérico: sin ramas ni manejo de texto
+    r = scr_mgdl / K
+    return 142 * (min(r, 1) ** a) * (max(r, 1) ** -1.200) * (0.9938 ** age) * adj
 
 def egfr_ckdepi_2021(scr_mgdl: float, age: int, sex: str) -> float:
-    is_female = str(sex).lower().startswith(("f", "muj"))
-    K = 0.7 if is_female else 0.9
-    a = -0.241 if is_female else -0.302
-    egfr = 142 * (min(scr_mgdl / K, 1) ** a) * (max(scr_mgdl / K, 1) ** -1.200) * (0.9938 ** age)
-    if is_female:
-        egfr *= 1.012
-    return float(np.round(egfr, 1))
+    K, a, adj = _EGFR_MUJER if str(sex).lower().startswith(("f", "muj")) else _EGFR_HOMBRE
+    return round(float(_egfr_core(scr_mgdl, age, K, a, adj)), 1)
+
+def _clamp(v, lo, hi, nd=1):
+    # Acota v a [lo, hi]; siempre float para no mezclar int/float en number_input
+    if not isinstance(v, (int, float)):
+        try:
+            v = float(v)
+        except (TypeError, ValueError):
+            v = lo
+    return round(float(lo if v < lo else hi if v > hi else v), nd)
 
 def bmi(kg, cm):
     try:
@@ -91,14 +95,16 @@ def bmi(kg, cm):
     except Exception:
         return None
 
+# Cortes KDIGO de albuminuria (mg/g) y etiqueta de cada intervalo
+_UACR_EDGES = (30.0, 300.0)
+_UACR_LABELS = ("A1 (<30 mg/g)", "A2 (30-299 mg/g)", "A3 (≥300 mg/g)")
+
 def uacr_categoria(uacr_mgg):
     try:
         v = float(uacr_mgg)
     except:
         return "ND"
-    if v < 30: return "A1 (<30 mg/g)"
-    if v < 300: return "A2 (30-299 mg/g)"
-    return "A3 (≥300 mg/g)"
+    return _UACR_LABELS[bisect_right(_UACR_EDGES, v)]
 
 # ============== Catálogo de fármacos (sin instituciones; con alternativas) ==============
 # Datos mínimos para sugerencias y titulación simple
@@ -122,57 +128,85 @@ CATALOGO = [
     ("Insulina prandial", "Aspart/Lispro", "4 U/comida", "Según necesidad", "Reglas 500/1800 o según CGM."),
 ]
 
-CLASES = sorted(list({c for c,_,_,_,_ in CATALOGO}))
+# Derivados del catálogo construidos una vez por proceso (Streamlit re-ejecuta el script en cada rerun).
+# Se comparten entre sesiones: solo lectura. Recibe CATALOGO como argumento para invalidarse si cambia.
+@st.cache_resource
+def _catalogo(catalogo):
+    df = pd.DataFrame(catalogo, columns=["clase", "fármaco", "inicio", "máxima", "nota"])
+    df["clase"] = df["clase"].astype("category")
+    por_clase = {}
+    for d in catalogo:
+        por_clase.setdefault(d[0], []).append(d)
+    # Texto de titulación ya formateado por fármaco
+    sugerencias = {n: f"Inicio sugerido: **{inicio}** · **Máxima:** {maxd}. {nota}" for _, n, inicio, maxd, nota in catalogo}
+    return df, por_clase, sorted(por_clase), [d[1] for d in catalogo], sugerencias
+
+CATALOGO_DF, CATALOGO_POR_CLASE, CLASES, FARMACOS_NOMBRES, SUGERENCIAS = _catalogo(CATALOGO)
 
 def alternativas_de_clase(clase, excluir=None):
-    out = [d for d in CATALOGO if d[0] == clase]
+    out = CATALOGO_POR_CLASE.get(clase, [])
     if excluir:
         out = [d for d in out if d[1] != excluir]
-    return out
+    return list(out)
+
+# Rangos seguros por unidad: (mín, máx, valor inicial) para glucosas; (mín, máx) para metas
+UNIT_BOUNDS = {
+    "mg/dL": {
+        "gluc_ayunas": (50.0, 600.0, 150.0), "gluc_pp": (50.0, 600.0, 190.0),
+        "gluc_actual": (50.0, 600.0, 160.0), "gluc_objetivo": (80.0, 300.0, 110.0),
+        "pre_min": (70.0, 400.0), "pre_max": (90.0, 400.0), "pp_max": (108.0, 400.0),
+    },
+    "mmol/L": {
+        "gluc_ayunas": (2.0, 33.3, 8.3), "gluc_pp": (2.0, 33.3, 10.5),
+        "gluc_actual": (2.0, 33.3, 8.9), "gluc_objetivo": (4.4, 16.7, 6.1),
+        "pre_min": (3.9, 22.2), "pre_max": (5.0, 22.2), "pp_max": (6.0, 22.2),
+    },
+}
 
 # ============== Sidebar (datos del paciente) ==============
 with st.sidebar:
     st.header("Paciente")
-    unidad_gluc = st.selectbox("Unidades de glucosa", ["mg/dL", "mmol/L"])
-    nombre = st.text_input("Nombre", "")
-    edad = st.number_input("Edad (años)", 18, 100, 55, key="edad")
-    sexo = st.selectbox("Sexo biológico", ["Femenino", "Masculino"])
-    dx = st.selectbox("Diagnóstico", ["DM2", "DM1"])
-    peso = st.number_input("Peso (kg)", 25.0, 300.0, 80.0, step=0.5, key="peso")
-    talla = st.number_input("Talla (cm)", 120, 230, 170, key="talla")
-    imc_val = bmi(peso, talla)
-    st.caption(f"IMC: **{imc_val if imc_val else 'ND'} kg/m²**")
-
-    a1c = st.number_input("A1c (%)", 4.0, 15.0, 8.2, step=0.1, key="a1c")
-    # Entradas de glucosa por unidad (rango seguro por unidad)
-    ay_min = 2.0 if unidad_gluc == "mmol/L" else 50.0
-    ay_max = 33.3 if unidad_gluc == "mmol/L" else 600.0
-    pp_min = 2.0 if unidad_gluc == "mmol/L" else 50.0
-    pp_maxx = 33.3 if unidad_gluc == "mmol/L" else 600.0
-
-    gluc_ayunos = st.number_input(
-        f"Glucosa en ayunas ({unidad_gluc})", min_value=ay_min, max_value=ay_max,
-        value=8.3 if unidad_gluc == "mmol/L" else 150.0,
-        key=f"ay_{unidad_gluc}"
-    )
-    gluc_pp_in = st.number_input(
-        f"Glucosa 120 min ({unidad_gluc})", min_value=pp_min, max_value=pp_maxx,
-        value=10.5 if unidad_gluc == "mmol/L" else 190.0,
-        key=f"pp_{unidad_gluc}"
-    )
-
-    def to_mgdl(val):
-        return mmoll_to_mgdl(val) if unidad_gluc == "mmol/L" else float(val)
-
-    gluc_ayunas = to_mgdl(gluc_ayunos)
-    gluc_pp = to_mgdl(gluc_pp_in)
-
-    scr = st.number_input("Creatinina sérica (mg/dL)", 0.2, 12.0, 1.0, step=0.1, key="scr")
-    uacr = st.number_input("UACR (mg/g)", 0.0, 10000.0, 20.0, step=1.0, key="uacr")
-    uacr_cat = uacr_categoria(uacr)
-    ascvd = st.checkbox("ASCVD (IAM/angina/ictus/PAD)")
-    ic = st.checkbox("Insuficiencia cardiaca")
-    ckd_conocida = st.checkbox("CKD conocida")
+    unidad_gluc = st.selectbox("Unidades de glucosa", ["mg/dL", "mmol/L"], key="unidad_gluc")
+    b = UNIT_BOUNDS[unidad_gluc]
+    es_mmol = unidad_gluc == "mmol/L"
+    # Datos clínicos en un formulario: los cálculos se rehacen solo al pulsar "Recalcular".
+    # La unidad queda fuera porque cambia los rangos y claves de los campos de glucosa.
+    with st.form("paciente", border=False):
+        nombre = st.text_input("Nombre", "")
+        edad = st.number_input("Edad (años)", 18, 100, 55, key="edad")
+        sexo = st.selectbox("Sexo biológico", ["Femenino", "Masculino"])
+        dx = st.selectbox("Diagnóstico", ["DM2", "DM1"])
+        peso = st.number_input("Peso (kg)", 25.0, 300.0, 80.0, step=0.5, key="peso")
+        talla = st.number_input("Talla (cm)", 120, 230, 170, key="talla")
+        imc_val = bmi(peso, talla)
+        st.caption(f"IMC: **{imc_val if imc_val else 'ND'} kg/m²**")
+
+        a1c = st.number_input("A1c (%)", 4.0, 15.0, 8.2, step=0.1, key="a1c")
+        # Entradas de glucosa por unidad (rango seguro por unidad)
+        mn, mx, dflt = b["gluc_ayunas"]
+        gluc_ayunos = st.number_input(
+            f"Glucosa en ayunas ({unidad_gluc})", min_value=mn, max_value=mx, value=dflt,
+            key=f"ay_{unidad_gluc}"
+        )
+        mn, mx, dflt = b["gluc_pp"]
+        gluc_pp_in = st.number_input(
+            f"Glucosa 120 min ({unidad_gluc})", min_value=mn, max_value=mx, value=dflt,
+            key=f"pp_{unidad_gluc}"
+        )
+
+        def to_mgdl(val):
+            return mmoll_to_mgdl(val) if es_mmol else float(val)
+
+        gluc_ayunas = to_mgdl(gluc_ayunos)
+        gluc_pp = to_mgdl(gluc_pp_in)
+
+        scr = st.number_input("Creatinina sérica (mg/dL)", 0.2, 12.0, 1.0, step=0.1, key="scr")
+        uacr = st.number_input("UACR (mg/g)", 0.0, 10000.0, 20.0, step=1.0, key="uacr")
+        uacr_cat = uacr_categoria(uacr)
+        ascvd = st.checkbox("ASCVD (IAM/angina/ictus/PAD)")
+        ic = st.checkbox("Insuficiencia cardiaca")
+        ckd_conocida = st.checkbox("CKD conocida")
+        st.form_submit_button("Recalcular", use_container_width=True)
 
 # ============== Cálculos básicos ==============
 egfr = egfr_ckdepi_2021(scr, int(edad), sexo)
@@ -190,21 +224,18 @@ st.subheader("Metas activas")
 a1c_meta = st.number_input("A1c meta (%)", 5.5, 9.0, metas["A1c_max"], 0.1, key="a1c_meta")
 
 # límites por unidad
-pre_min_min  = 3.9 if unidad_gluc == "mmol/L" else 70.0
-pre_min_max  = 22.2 if unidad_gluc == "mmol/L" else 400.0
-pre_max_min  = 5.0 if unidad_gluc == "mmol/L" else 90.0
-pre_max_max  = 22.2 if unidad_gluc == "mmol/L" else 400.0
-pp_max_min   = 6.0 if unidad_gluc == "mmol/L" else 108.0
-pp_max_max   = 22.2 if unidad_gluc == "mmol/L" else 400.0
+pre_min_min, pre_min_max = b["pre_min"]
+pre_max_min, pre_max_max = b["pre_max"]
+pp_max_min,  pp_max_max  = b["pp_max"]
 
 # defaults convertidos
-pre_min_def  = mgdl_to_mmoll(metas["pre_min"]) if unidad_gluc == "mmol/L" else metas["pre_min"]
-pre_max_def  = mgdl_to_mmoll(metas["pre_max"]) if unidad_gluc == "mmol/L" else metas["pre_max"]
-pp_max_def   = mgdl_to_mmoll(metas["pp_max"])  if unidad_gluc == "mmol/L" else metas["pp_max"]
+pre_min_def  = mgdl_to_mmoll(metas["pre_min"]) if es_mmol else metas["pre_min"]
+pre_max_def  = mgdl_to_mmoll(metas["pre_max"]) if es_mmol else metas["pre_max"]
+pp_max_def   = mgdl_to_mmoll(metas["pp_max"])  if es_mmol else metas["pp_max"]
 # clamp
-pre_min_def = max(pre_min_min, min(pre_min_def, pre_min_max))
-pre_max_def = max(pre_max_min, min(pre_max_def, pre_max_max))
-pp_max_def  = max(pp_max_min,  min(pp_max_def,  pp_max_max))
+pre_min_def = _clamp(pre_min_def, pre_min_min, pre_min_max)
+pre_max_def = _clamp(pre_max_def, pre_max_min, pre_max_max)
+pp_max_def  = _clamp(pp_max_def,  pp_max_min,  pp_max_max)
 
 col_m1, col_m2, col_m3 = st.columns(3)
 with col_m1:
@@ -229,50 +260,53 @@ with col_m3:
 st.caption(f"eGFR (CKD-EPI 2021): **{egfr} mL/min/1.73m²** · UACR: **{uacr} mg/g** ({uacr_cat})")
 
 # ============== Reglas de decisión y textos ==============
-def recomendacion_farmacos(tipo_dm, a1c, gl_ay, gl_pp, egfr, ckd, ascvd, ic, imc):
+def recomendacion_farmacos(tipo_dm, a1c, gl_ay, gl_pp, egfr, ckd, ascvd, ic, imc, uacr_cat, pp_max_mgdl, a1c_meta):
+    # Función pura (sin globales): la justificación se calcula siempre y el modo docente decide si mostrarla.
+    # Sin st.cache_data: una docena de comparaciones cuesta menos que hashear argumentos y copiar el resultado
     lines, just = [], []
     if tipo_dm == "DM1":
         lines.append("DM1 → necesario esquema con **insulina basal-bolo** o sistema AID; educación y conteo de carbohidratos.")
-        if docente:
-            just.append("DM1 depende de insulina exógena – los orales no cubren el déficit absoluto.")
+        just.append("DM1 depende de insulina exógena – los orales no cubren el déficit absoluto.")
         return lines, just
 
+    ckd_o_egfr_bajo = ckd or egfr < 60
+
     # umbrales “ADA style”
     if (a1c is not None and a1c > 10) or (gl_ay is not None and gl_ay >= 300):
         lines.append("**Iniciar/optimizar insulina** (basal ± prandial) desde el inicio.")
-        if docente: just.append("A1c >10% o glucosa ≥300 mg/dL o síntomas catabólicos: se prioriza insulina.")
+        just.append("A1c >10% o glucosa ≥300 mg/dL o síntomas catabólicos: se prioriza insulina.")
 
     if ic:
         lines.append("**IC** → priorizar **SGLT2i** (beneficio en IC).")
-        if docente: just.append("SGLT2i reduce hospitalización por IC.")
+        just.append("SGLT2i reduce hospitalización por IC.")
     if ascvd:
         lines.append("**ASCVD** → **GLP-1 RA** con beneficio CV o **SGLT2i**.")
-        if docente: just.append("GLP-1 RA/SGLT2i con evidencia de MACE ↓.")
+        just.append("GLP-1 RA/SGLT2i con evidencia de MACE ↓.")
     if imc and imc >= 30:
         lines.append("**Obesidad** → preferir **GLP-1 RA** por efecto en peso.")
-        if docente: just.append("GLP-1 RA favorece pérdida de peso clínicamente significativa.")
+        just.append("GLP-1 RA favorece pérdida de peso clínicamente significativa.")
 
-    if (ckd or egfr < 60):
+    if ckd_o_egfr_bajo:
         if egfr >= 20:
             lines.append("**CKD** → agregar **SGLT2i** para protección renal/CV (eGFR ≥20).")
-            if docente: just.append("SGLT2i retrasa progresión CKD; eficacia hipoglucemiante menor con eGFR <45.")
+            just.append("SGLT2i retrasa progresión CKD; eficacia hipoglucemiante menor con eGFR <45.")
         else:
             lines.append("**CKD avanzada** (eGFR <20) → preferir **GLP-1 RA** para control glucémico.")
-        if "A2" in uacr_cat or "A3" in uacr_cat:
+        if uacr_cat.startswith(("A2", "A3")):
             lines.append("**Albuminuria A2/A3** → IECA/ARA2 si procede (nefroprotección).")
 
     if egfr >= 45:
         lines.append("**Metformina** útil y segura (eGFR ≥45).")
-    elif 30 <= egfr < 45:
+    elif egfr >= 30:
         lines.append("Metformina si ya la usaba → **máx 1000 mg/d**; **evitar iniciar** en 30-44.")
     else:
         lines.append("**Metformina contraindicada** eGFR <30.")
 
-    if gl_pp and gl_pp > (pp_max if unidad_gluc=="mg/dL" else mmoll_to_mgdl(pp_max)):
+    if gl_pp and gl_pp > pp_max_mgdl:
         lines.append("**Posprandial alta** → GLP-1 RA o añadir **bolo prandial**; revisar raciones/tiempos.")
 
     # Si no hay motivos de alto riesgo:
-    if not (ic or ascvd or ckd or egfr < 60) and not ((a1c and a1c > a1c_meta) and (gl_ay and gl_ay > 130)):
+    if not (ic or ascvd or ckd_o_egfr_bajo) and not ((a1c and a1c > a1c_meta) and (gl_ay and gl_ay > 130)):
         lines.append("**Metformina** + estilo de vida; valorar **GLP-1 RA** o **SGLT2i** si no se alcanza meta.")
     return lines, just
 
@@ -302,6 +336,11 @@ def intensificacion_prandial(basal_ud, peso_kg):
         "Alternativa: **GLP-1 RA** antes del bolo (peso/adhesión)."
     ]
 
+def calcular_bolo(carbs_g, g_act_mgdl, g_obj_mgdl, icr, cf):
+    # carbohidratos/ICR + corrección (solo si está por encima del objetivo), a la media unidad más cercana
+    u = (carbs_g / icr if icr > 0 else 0.0) + (max(0.0, (g_act_mgdl - g_obj_mgdl) / cf) if cf > 0 else 0.0)
+    return int(u * 2 + 0.5) / 2.0
+
 def ajustes_por_egfr(egfr):
     out = []
     if egfr >= 45: out.append("Metformina: **dosis plena** si tolera.")
@@ -317,6 +356,121 @@ def ajustes_por_egfr(egfr):
     ]
     return out
 
+# ============== PDFs ==============
+# Definidos a nivel de módulo; reportlab se importa al generar el primer PDF, no en cada rerun
+# Un TextWrapper por (fuente, tamaño, margen, viñeta) en un dict simple: sin hash ni lock por llamada.
+# El ancho en caracteres sale del ancho útil de la página entre el ancho de "x", que es un carácter típico,
+# no el máximo: líneas en mayúsculas pueden pasarse del margen (92 car. ≈ 522 pt frente a 468 pt útiles)
+_WRAPPERS = {}
+
+def _wrapper(font, size, left, bullet):
+    clave = (font, size, left, bullet)
+    w = _WRAPPERS.get(clave)
+    if w is None:
+        from reportlab.lib.pagesizes import letter
+        from reportlab.pdfbase.pdfmetrics import stringWidth
+        util = letter[0] - 2 * left - stringWidth(bullet, font, size)
+        w = _WRAPPERS[clave] = textwrap.TextWrapper(width=int(util / stringWidth("x", font, size)),
+                                                    break_long_words=False, break_on_hyphens=False)
+    return w
+
+def wrap_lines(c, to, left, text, bullet="- ", font="Helvetica", size=10):
+    # Añade `text` cortado por palabras al objeto de texto `to` (un solo BT…ET por página);
+    # al llegar al margen inferior lo dibuja, abre página nueva y devuelve el objeto que sigue
+    from reportlab.lib.pagesizes import letter
+    for seg in _wrapper(font, size, left, bullet).wrap(text):
+        to.textLine(f"{bullet}{seg}")
+        if to.getY() < 72:
+            c.drawText(to); c.showPage()
+            to = c.beginText(left, letter[1] - 72); to.setFont(font, size, leading=14)
+    return to
+
+# PDFs cacheados por contenido: un rerun con los mismos datos devuelve los bytes ya generados
+@st.cache_data(max_entries=32, show_spinner=False)
+def pdf_plan(datos_paciente, recomendaciones, justificacion):
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.units import inch
+    buffer = BytesIO(); c = canvas.Canvas(buffer, pagesize=letter)
+    left = 1 * inch
+    # Un solo objeto de texto para todo el documento; los títulos cambian de fuente dentro de él
+    to = c.beginText(left, letter[1] - 1 * inch)
+    to.setFont("Helvetica-Bold", 12, leading=20); to.textLine("Plan terapéutico para Diabetes (ADA 2025)")
+    to.setFont("Helvetica", 10, leading=14)
+    for k, v in datos_paciente.items():
+        to = wrap_lines(c, to, left, f"{k}: {v}", bullet="")
+    for titulo, lineas, bullet in (("Tratamiento indicado:", recomendaciones, "- "),
+                                   ("Justificación clínica:", justificacion, "• ")):
+        to.setTextOrigin(left, to.getY() - 6)
+        to.setFont("Helvetica-Bold", 11, leading=16); to.textLine(titulo)
+        to.setFont("Helvetica", 10, leading=14)
+        for line in lineas: to = wrap_lines(c, to, left, line, bullet=bullet)
+    to.setTextOrigin(left, to.getY() - 10); to.setFont("Helvetica-Oblique", 8)
+    to.textOut("Basado en ADA Standards of Care 2025; esta hoja no sustituye el juicio clínico.")
+    c.drawText(to)
+    c.save(); return buffer.getvalue()
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def pdf_registro(nombre, unidad, fecha):
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.units import inch
+    buffer = BytesIO(); c = canvas.Canvas(buffer, pagesize=letter)
+    left = 0.7 * inch; top = letter[1] - 0.7 * inch
+    c.setFont("Helvetica-Bold", 12); c.drawString(left, top, f"Registro de glucosa capilar (7 días) – Unidades: {unidad}")
+    c.setFont("Helvetica", 10); c.drawString(left, top - 16, f"Paciente: {nombre}    Fecha inicio: {fecha}")
+    cols = ["Día","Ayunas","Des","Comida","Cena","2h Des","2h Com","2h Cena"]; col_w = [0.8,0.8,0.8,0.8,0.8,0.9,0.9,0.9]
+    # x de cada columna precalculada (antes: sum(col_w[:i]) por celda)
+    col_x = [left + o * inch for o in accumulate(col_w, initial=0.0)]; right_x = col_x[-1]
+    # Toda la rejilla en un solo objeto de texto y un solo c.lines() para las líneas horizontales
+    y = top - 40; to = c.beginText(); to.setFont("Helvetica-Bold", 9)
+    for x, h in zip(col_x, cols): to.setTextOrigin(x, y); to.textOut(h)
+    y -= 4; lineas = [(left, y, right_x, y)]
+    to.setFont("Helvetica", 9)
+    for d in range(1, 8):
+        y -= 18; to.setTextOrigin(left, y); to.textOut(f"D{d}")
+        for x in col_x[1:-1]: to.setTextOrigin(x + 4, y); to.textOut("____")
+        lineas.append((left, y-4, right_x, y-4))
+    c.drawText(to)
+    c.setLineWidth(0.5); c.lines(lineas)
+    c.save(); return buffer.getvalue()
+
+# Textos de la hoja de alta ya formateados por unidad (umbrales 70/300 mg/dL ≈ 3.9/16.7 mmol/L)
+SECCIONES_ALTA = {
+    u: (
+        ("Cuidados generales", (
+            "Tomar medicamentos según indicación; no suspender sin consultar.",
+            "Monitorear glucosa con la frecuencia indicada; registrar valores.",
+            "Hidratación, alimentación balanceada y actividad física segura."
+        )),
+        ("Señales de alarma – acudir a urgencias", (
+            f"Hipoglucemia severa: glucosa <{hipo} {u} con síntomas o pérdida de conciencia.",
+            f"Hiperglucemia persistente: >{hiper} {u} repetida o síntomas de cetoacidosis.",
+            "Infección grave, dolor torácico, déficit neurológico súbito, deshidratación marcada."
+        )),
+    )
+    for u, hipo, hiper in (("mg/dL", "70", "300"), ("mmol/L", "3.9", "16.7"))
+}
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def pdf_alta(nombre, unidad, fecha):
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.units import inch
+    buffer = BytesIO(); c = canvas.Canvas(buffer, pagesize=letter)
+    left = 0.7 * inch; top = letter[1] - 0.7 * inch
+    to = c.beginText(left, top)
+    to.setFont("Helvetica-Bold", 12, leading=16); to.textLine("Hoja de alta y señales de alarma")
+    to.setFont("Helvetica", 10, leading=16); to.textLine(f"Paciente: {nombre}    Fecha: {fecha}    Unidades: {unidad}")
+    for titulo, items in SECCIONES_ALTA[unidad]:
+        to.setTextOrigin(left, to.getY() - 10)
+        to.setFont("Helvetica-Bold", 11, leading=14); to.textLine(titulo)
+        to.setFont("Helvetica", 10, leading=14)
+        for it in items:
+            to = wrap_lines(c, to, left, it, bullet="• ")
+    c.drawText(to)
+    c.save(); return buffer.getvalue()
+
 # ============== Tratamiento actual y titulación ==============
 st.subheader("Tratamiento actual y titulación")
 st.caption("Registra lo que usa el/la paciente para sugerir escalamiento o cambio.")
@@ -329,14 +483,18 @@ ejemplo = [
 ]
 key_data = "tabla_trat"
 if key_data not in st.session_state:
-    st.session_state[key_data] = pd.DataFrame(ejemplo, columns=df_cols)
+    # clase/fármaco como categóricos: el editor serializa códigos en vez de cadenas repetidas
+    _semilla = pd.DataFrame(ejemplo, columns=df_cols)
+    _semilla["clase"] = _semilla["clase"].astype(pd.CategoricalDtype(CLASES))
+    _semilla["fármaco"] = _semilla["fármaco"].astype(pd.CategoricalDtype(FARMACOS_NOMBRES))
+    st.session_state[key_data] = _semilla
 
 edit_df = st.data_editor(
     st.session_state[key_data],
     num_rows="dynamic",
-    columns={
+    column_config={
         "clase": st.column_config.SelectboxColumn(options=CLASES, required=True),
-        "fármaco": st.column_config.SelectboxColumn(options=[d[1] for d in CATALOGO], required=True),
+        "fármaco": st.column_config.SelectboxColumn(options=FARMACOS_NOMBRES, required=True),
         "dosis actual": st.column_config.TextColumn(help="Ej. 850 mg / 10 U"),
         "frecuencia": st.column_config.TextColumn(help="Ej. c/12 h, c/24 h, desayuno/cena")
     },
@@ -345,29 +503,45 @@ edit_df = st.data_editor(
 )
 st.session_state[key_data] = edit_df
 
-# Sugerencias por fila
-def sugerencia_para(farmaco):
-    rows = [d for d in CATALOGO if d[1] == farmaco]
-    if not rows:
-        return None
-    c, n, inicio, maxd, nota = rows[0]
-    return f"Inicio sugerido: **{inicio}** · **Máxima:** {maxd}. {nota}"
-
-sug_txt = []
-for _, row in edit_df.iterrows():
-    tip = sugerencia_para(row["fármaco"])
-    if tip:
-        sug_txt.append(f"- {row['fármaco']}: {tip}")
+# Sugerencias por fila: map contra el diccionario ya formateado (sin llamada por fila)
+farm = edit_df["fármaco"].astype(object)
+tips = farm.map(SUGERENCIAS)
+con_tip = tips.notna()
+sug_txt = ("- " + farm[con_tip] + ": " + tips[con_tip]).tolist()
 
 if sug_txt:
     st.markdown("**Sugerencias de titulación:**")
     for t in sug_txt:
         st.markdown(t)
 
-# ============== Tabs de trabajo ==============
-tab_res, tab_plan, tab_cat, tab_edu = st.tabs(["📊 Resumen", "🧭 Plan terapéutico", "💊 Catálogo", "📚 Educación"])
+# ============== Motor de decisiones (una vez por rerun; Resumen y Plan reusan los resultados) ==============
+pp_max_mgdl = mmoll_to_mgdl(pp_max) if es_mmol else pp_max
+recs, just = recomendacion_farmacos(dx, a1c, gluc_ayunas, gluc_pp, egfr, ckd_conocida, ascvd, ic, imc_val,
+                                    uacr_cat, pp_max_mgdl, a1c_meta)
+intro_basal, reglas_basal = basal_init_titration(dx, peso, a1c, alto_riesgo_hipo=False)
+prandial = intensificacion_prandial(basal_ud=max(10, round(0.1 * peso)), peso_kg=peso) if dx == "DM2" else []
+ajustes_renales = ajustes_por_egfr(egfr)
 
-with tab_res:
+# ============== Tabs de trabajo ==============
+# Selector de sección en lugar de st.tabs: st.tabs ejecuta todas las pestañas en cada rerun,
+# aquí solo corre la sección visible (calculadora PRO, PDFs, etc.)
+SECCIONES = ["📊 Resumen", "🧭 Plan terapéutico", "💊 Catálogo", "📚 Educación"]
+seccion = st.radio("Sección", SECCIONES, horizontal=True, key="active_tab", label_visibility="collapsed")
+
+# Streamlit borra el estado de un widget que no se dibuja en el rerun: las claves de las secciones ocultas
+# se re-asignan para que la calculadora PRO y los filtros del catálogo conserven sus valores al volver
+_ESTADO_PRO = ("tdd_man", "icr", "cf", "carbs", *(f"{p}_{u}" for p in ("gact", "gobj") for u in UNIT_BOUNDS))
+_ESTADO_CATALOGO = ("f_clase", "clase_sel", *(f"farm_sel_{c}" for c in CLASES))
+ocultas = ()
+if not (seccion == SECCIONES[0] and modo == "PRO"):
+    ocultas += _ESTADO_PRO
+if seccion != SECCIONES[2]:
+    ocultas += _ESTADO_CATALOGO
+for k in ocultas:
+    if k in st.session_state:
+        st.session_state[k] = st.session_state[k]
+
+if seccion == SECCIONES[0]:
     st.markdown("#### Panorama clínico")
     st.markdown(
         f"""
@@ -379,7 +553,6 @@ with tab_res:
         """, unsafe_allow_html=True
     )
 
-    recs, just = recomendacion_farmacos(dx, a1c, gluc_ayunas, gluc_pp, egfr, ckd_conocida, ascvd, ic, imc_val)
     st.markdown("#### Recomendación terapéutica (ADA – priorización por riesgo)")
     for r in recs:
         st.markdown(f"- {r}")
@@ -389,19 +562,17 @@ with tab_res:
             st.markdown(f"• {j}")
 
     st.markdown("#### Insulina: dosis de inicio y titulación")
-    intro_basal, reglas_basal = basal_init_titration(dx, peso, a1c, alto_riesgo_hipo=False)
     st.markdown(f"- {intro_basal}")
     for rr in reglas_basal:
         st.markdown(f"  - {rr}")
 
-    if dx == "DM2":
-        basal_ref = max(10, round(0.1 * peso))
+    if prandial:
         st.markdown("**Intensificación prandial (si A1c persiste alta):**")
-        for p in intensificacion_prandial(basal_ud=basal_ref, peso_kg=peso):
+        for p in prandial:
             st.markdown(f"- {p}")
 
     st.markdown("#### Ajustes por función renal")
-    for a in ajustes_por_egfr(egfr):
+    for a in ajustes_renales:
         st.markdown(f"- {a}")
 
     if modo == "PRO":
@@ -424,18 +595,15 @@ with tab_res:
         with colp1:
             carbs = st.number_input("Carbohidratos (g)", 0.0, 300.0, 45.0, step=1.0, key="carbs")
         with colp2:
+            mn, mx, dflt = b["gluc_actual"]
             g_act = st.number_input(
-                f"Glucosa actual ({unidad_gluc})",
-                min_value=ay_min, max_value=ay_max,
-                value=8.9 if unidad_gluc=="mmol/L" else 160.0,
+                f"Glucosa actual ({unidad_gluc})", min_value=mn, max_value=mx, value=dflt,
                 key=f"gact_{unidad_gluc}"
             )
         with colp3:
+            mn, mx, dflt = b["gluc_objetivo"]
             g_obj = st.number_input(
-                f"Glucosa objetivo ({unidad_gluc})",
-                min_value=4.4 if unidad_gluc=="mmol/L" else 80.0,
-                max_value=16.7 if unidad_gluc=="mmol/L" else 300.0,
-                value=6.1 if unidad_gluc=="mmol/L" else 110.0,
+                f"Glucosa objetivo ({unidad_gluc})", min_value=mn, max_value=mx, value=dflt,
                 key=f"gobj_{unidad_gluc}"
             )
         g_act_mgdl = to_mgdl(g_act)
@@ -444,87 +612,15 @@ with tab_res:
             st.warning("Glucosa actual <70 mg/dL: tratar hipoglucemia antes de bolo.")
             dosis_bolo = 0.0
         else:
-            dosis_bolo = max(0.0, carbs / icr + max(0.0, (g_act_mgdl - g_obj_mgdl) / cf))
-            dosis_bolo = round(dosis_bolo * 2) / 2.0
+            dosis_bolo = calcular_bolo(carbs, g_act_mgdl, g_obj_mgdl, icr, cf)
         st.metric("Dosis de bolo sugerida", f"{dosis_bolo} U")
         if docente:
             st.caption("Docente: ICR≈500/TDD, CF≈1800/TDD (reglas empíricas; individualizar con CGM).")
 
-with tab_plan:
+if seccion == SECCIONES[1]:
     st.markdown("#### Plan terapéutico imprimible")
-    # armar listas texto
-    recs, just = recomendacion_farmacos(dx, a1c, gluc_ayunas, gluc_pp, egfr, ckd_conocida, ascvd, ic, imc_val)
-    texto_basal, reglas = basal_init_titration(dx, peso, a1c)
-    plan = recs + [f"Inicio de insulina: {texto_basal}"] + reglas
-    if dx == "DM2":
-        plan += intensificacion_prandial(max(10, round(0.1*peso)), peso)
-    plan += ajustes_por_egfr(egfr)
-
-    # PDFs
-    def wrap_lines(c, left, y, width, text, bullet="- "):
-        for seg in [text[i:i+95] for i in range(0, len(text), 95)]:
-            c.drawString(left, y, f"{bullet}{seg}")
-            y -= 14
-            if y < 72:
-                c.showPage(); y = letter[1] - 72
-        return y
-
-    def pdf_plan(datos_paciente, recomendaciones, justificacion):
-        buffer = BytesIO(); c = canvas.Canvas(buffer, pagesize=letter)
-        width, height = letter; left = 1 * inch; y = height - 1 * inch
-        c.setFont("Helvetica-Bold", 12); c.drawString(left, y, "Plan terapéutico para Diabetes (ADA 2025)"); y -= 20
-        c.setFont("Helvetica", 10)
-        for k, v in datos_paciente.items():
-            y = wrap_lines(c, left, y, width, f"{k}: {v}", bullet="")
-        y -= 6; c.setFont("Helvetica-Bold", 11); c.drawString(left, y, "Tratamiento indicado:"); y -= 16; c.setFont("Helvetica", 10)
-        for line in recomendaciones: y = wrap_lines(c, left, y, width, line, bullet="- ")
-        y -= 6; c.setFont("Helvetica-Bold", 11); c.drawString(left, y, "Justificación clínica:"); y -= 16; c.setFont("Helvetica", 10)
-        for line in justificacion: y = wrap_lines(c, left, y, width, line, bullet="• ")
-        c.setFont("Helvetica-Oblique", 8); y -= 10
-        c.drawString(left, y, "Basado en ADA Standards of Care 2025; esta hoja no sustituye el juicio clínico.")
-        c.save(); buffer.seek(0); return buffer
-
-    def pdf_registro(nombre, unidad):
-        buffer = BytesIO(); c = canvas.Canvas(buffer, pagesize=letter)
-        left = 0.7 * inch; top = letter[1] - 0.7 * inch
-        c.setFont("Helvetica-Bold", 12); c.drawString(left, top, f"Registro de glucosa capilar (7 días) – Unidades: {unidad}")
-        c.setFont("Helvetica", 10); c.drawString(left, top - 16, f"Paciente: {nombre}    Fecha inicio: {date.today().isoformat()}")
-        cols = ["Día","Ayunas","Des","Comida","Cena","2h Des","2h Com","2h Cena"]; col_w = [0.8,0.8,0.8,0.8,0.8,0.9,0.9,0.9]
-        y = top - 40; c.setFont("Helvetica-Bold", 9)
-        for i, h in enumerate(cols): c.drawString(left + sum(col_w[:i])*inch, y, h)
-        c.setLineWidth(0.5); y -= 4; c.line(left, y, left + sum(col_w)*inch, y)
-        c.setFont("Helvetica", 9)
-        for d in range(1, 8):
-            y -= 18; c.drawString(left, y, f"D{d}")
-            for i in range(1, len(cols)): c.drawString(left + sum(col_w[:i])*inch + 4, y, "____")
-            c.line(left, y-4, left + sum(col_w)*inch, y-4)
-        c.save(); buffer.seek(0); return buffer
-
-    def pdf_alta(nombre, unidad):
-        buffer = BytesIO(); c = canvas.Canvas(buffer, pagesize=letter)
-        left = 0.7 * inch; top = letter[1] - 0.7 * inch
-        c.setFont("Helvetica-Bold", 12); c.drawString(left, top, "Hoja de alta y señales de alarma")
-        c.setFont("Helvetica", 10); y = top - 16
-        c.drawString(left, y, f"Paciente: {nombre}    Fecha: {date.today().isoformat()}    Unidades: {unidad}"); y -= 16
-        secciones = [
-            ("Cuidados generales", [
-                "Tomar medicamentos según indicación; no suspender sin consultar.",
-                "Monitorear glucosa con la frecuencia indicada; registrar valores.",
-                "Hidratación, alimentación balanceada y actividad física segura."
-            ]),
-            ("Señales de alarma – acudir a urgencias", [
-                f"Hipoglucemia severa: glucosa <70 {unidad} con síntomas o pérdida de conciencia.",
-                f"Hiperglucemia persistente: >300 {unidad} repetida o síntomas de cetoacidosis.",
-                "Infección grave, dolor torácico, déficit neurológico súbito, deshidratación marcada."
-            ])
-        ]
-        for titulo, items in secciones:
-            y -= 10; c.setFont("Helvetica-Bold", 11); c.drawString(left, y, titulo); y -= 14; c.setFont("Helvetica", 10)
-            for it in items:
-                for seg in [it[i:i+95] for i in range(0, len(it), 95)]:
-                    c.drawString(left, y, f"• {seg}"); y -= 14
-                    if y < 72: c.showPage(); y = letter[1] - 72
-        c.save(); buffer.seek(0); return buffer
+    # armar listas texto (una sola lista, sin copias intermedias)
+    plan = [*recs, f"Inicio de insulina: {intro_basal}", *reglas_basal, *prandial, *ajustes_renales]
 
     datos = {
         "Nombre": nombre or "—",
@@ -543,32 +639,30 @@ with tab_plan:
 
     c1, c2, c3 = st.columns(3)
     with c1:
-        if st.button("Generar PDF del plan"):
-            pdf_bytes = pdf_plan(datos, plan, just)
-            st.download_button("Descargar plan.pdf", data=pdf_bytes, file_name="plan_tratamiento_diabetes.pdf", mime="application/pdf")
+        pdf_bytes = pdf_plan(datos, plan, just if docente else [])
+        st.download_button("Descargar plan.pdf", data=pdf_bytes, file_name="plan_tratamiento_diabetes.pdf", mime="application/pdf")
     with c2:
-        if st.button("Generar PDF de registro"):
-            pdf_reg = pdf_registro(nombre or "—", unidad_gluc)
-            st.download_button("Descargar registro.pdf", data=pdf_reg, file_name="registro_glucosa_capilar.pdf", mime="application/pdf")
+        pdf_reg = pdf_registro(nombre or "—", unidad_gluc, datos["Fecha"])
+        st.download_button("Descargar registro.pdf", data=pdf_reg, file_name="registro_glucosa_capilar.pdf", mime="application/pdf")
     with c3:
-        if st.button("Generar PDF hoja de alta"):
-            pdf_ha = pdf_alta(nombre or "—", unidad_gluc)
-            st.download_button("Descargar alta.pdf", data=pdf_ha, file_name="hoja_alta_diabetes.pdf", mime="application/pdf")
+        pdf_ha = pdf_alta(nombre or "—", unidad_gluc, datos["Fecha"])
+        st.download_button("Descargar alta.pdf", data=pdf_ha, file_name="hoja_alta_diabetes.pdf", mime="application/pdf")
 
-with tab_cat:
+if seccion == SECCIONES[2]:
     st.markdown("#### Medicamentos disponibles (ADA)")
     st.caption("El catálogo no depende de instituciones; puedes elegir **alternativas** si no hay disponibilidad o hay intolerancia.")
     # Filtro por clase
-    f_clase = st.multiselect("Filtrar por clase", CLASES, default=CLASES)
-    tabla = pd.DataFrame([{"clase":c,"fármaco":n,"inicio":i,"máxima":m,"nota":nota} for c,n,i,m,nota in CATALOGO if c in f_clase])
+    f_clase = st.multiselect("Filtrar por clase", CLASES, default=CLASES, key="f_clase")
+    tabla = CATALOGO_DF.loc[CATALOGO_DF["clase"].isin(f_clase)]
     st.dataframe(tabla, use_container_width=True, hide_index=True)
 
     st.markdown("#### Sugerir alternativa")
     g1, g2 = st.columns(2)
     with g1:
-        clase_sel = st.selectbox("Clase objetivo", CLASES, index=0)
+        clase_sel = st.selectbox("Clase objetivo", CLASES, index=0, key="clase_sel")
     with g2:
-        farm_sel = st.selectbox("Si no disponible / intolerancia a", [d[1] for d in CATALOGO if d[0]==clase_sel])
+        farm_sel = st.selectbox("Si no disponible / intolerancia a", [d[1] for d in CATALOGO_POR_CLASE[clase_sel]],
+                                key=f"farm_sel_{clase_sel}")
     alts = alternativas_de_clase(clase_sel, excluir=farm_sel)
     if alts:
         st.markdown("**Alternativas en la misma clase:**")
@@ -577,7 +671,7 @@ with tab_cat:
     else:
         st.info("No hay alternativas para la combinación elegida.")
 
-with tab_edu:
+if seccion == SECCIONES[3]:
     st.markdown("#### Glosario educativo: mitos y realidades")
     st.markdown("""
 - **“Si empiezo insulina, ya no hay regreso.”** → Puede ser temporal o permanente; depende del control y evolución.